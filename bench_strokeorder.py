@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""Compare stroke order image formats: encode time against bytes uploaded.
+
+usage: bench_strokeorder.py [-n runs] <characters or image files>
+"""
+import argparse
+import io
+import statistics
+import time
+import urllib.request
+from os import path
+
+from PIL import Image
+
+from discordant.commands.general import _IMAGE_MODES, _crop_and_shift_img, \
+    _encode_img
+
+FORMATS = ["png", "palette", "grayscale", "webp"]
+URL = "http://classic.jisho.org/static/images/stroke_diagrams/{}_frames.png"
+
+
+def load(arg):
+    if path.exists(arg):
+        return [Image.open(arg)]
+    images = []
+    for char in arg:
+        with urllib.request.urlopen(URL.format(ord(char))) as response:
+            images.append(Image.open(io.BytesIO(response.read())))
+    return images
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--runs", type=int, default=20)
+    parser.add_argument("sources", nargs="+")
+    args = parser.parse_args()
+
+    images = [img for arg in args.sources for img in load(arg)]
+    print("{:<10} {:>10} {:>10} {:>10}".format(
+        "format", "bytes", "p50 ms", "max ms"))
+    for fmt in FORMATS:
+        times = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            buffer, _ = _encode_img(
+                _crop_and_shift_img(*images,
+                                    mode=_IMAGE_MODES.get(fmt, "RGBA")),
+                fmt)
+            times.append((time.perf_counter() - start) * 1000)
+        print("{:<10} {:>10} {:>10.2f} {:>10.2f}".format(
+            fmt, len(buffer.getvalue()), statistics.median(times),
+            max(times)))
+
+
+if __name__ == '__main__':
+    main()
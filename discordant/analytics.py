@@ -0,0 +1,138 @@
+import asyncio
+import sqlite3
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rollups (
+    hour INTEGER NOT NULL,
+    scope TEXT NOT NULL,
+    dimension TEXT NOT NULL,
+    key TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (hour, scope, dimension, key)
+);
+"""
+
+# an upsert in two steps, since ON CONFLICT needs sqlite 3.24
+_ROLLUP_INSERT = """
+INSERT OR IGNORE INTO rollups (hour, scope, dimension, key, count)
+VALUES (?, ?, ?, ?, 0)
+"""
+_ROLLUP_UPDATE = """
+UPDATE rollups SET count = count + ?
+WHERE hour = ? AND scope = ? AND dimension = ? AND key = ?
+"""
+
+DIMENSIONS = ("commands", "queries", "channels")
+
+
+def message_scope(message):
+    # what !top in the message's channel is allowed to see
+    if message.server:
+        return message.server.id
+    return "private:" + message.author.id
+
+
+class Analytics:
+    """Usage history, buffered in memory and written to sqlite in batches.
+
+    Only hourly counts are kept, which is all top() needs; raw events (and
+    with them every query verbatim and when it was made) are never stored.
+
+    record() only appends to a bounded deque, so it is safe to call from the
+    dispatch path. A background task flushes the buffer through a single
+    worker thread; events that arrive while the buffer is full are dropped
+    and counted rather than slowing anything down.
+
+    Every event has a scope, the server it happened in (or the user, for
+    private messages), and top() only reports on one scope at a time."""
+
+    def __init__(self, database="analytics.db", buffer_size=10000,
+                 flush_interval=5):
+        self.database = database
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.recorded = 0
+        self.dropped = 0
+        self._buffer = deque()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._conn = None
+        self._task = None
+
+    def record(self, name, query, channel, scope):
+        if len(self._buffer) >= self.buffer_size:
+            self.dropped += 1
+            return
+        self._buffer.append((time.time(), name, query, channel, scope))
+
+    def start(self, loop):
+        # on_ready fires again after every reconnect
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        batch = [self._buffer.popleft() for _ in range(len(self._buffer))]
+        try:
+            await self._run(self._write, batch)
+            self.recorded += len(batch)
+        except sqlite3.Error as e:
+            self.dropped += len(batch)
+            print("Analytics flush failed: {}".format(e), file=sys.stderr)
+
+    async def top(self, scope, dimension, limit=10, days=7):
+        return await self._run(self._top, scope, dimension, limit, days)
+
+    def _run(self, func, *args):
+        return asyncio.get_event_loop().run_in_executor(
+            self._executor, func, *args)
+
+    # everything below runs on the worker thread.
+
+    def _connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.database, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def _write(self, batch):
+        rollups = {}
+        for event_time, name, query, channel, scope in batch:
+            hour = int(event_time // 3600)
+            keys = [("commands", name), ("channels", channel)]
+            if query:
+                keys.append(("queries", "{} {}".format(name, query)))
+            for dimension, key in keys:
+                rollup = (hour, scope, dimension, key)
+                rollups[rollup] = rollups.get(rollup, 0) + 1
+        conn = self._connect()
+        with conn:
+            conn.executemany(_ROLLUP_INSERT, rollups)
+            conn.executemany(
+                _ROLLUP_UPDATE, [(v,) + k for k, v in rollups.items()])
+
+    def _top(self, scope, dimension, limit, days):
+        since = int((time.time() - days * 86400) // 3600)
+        return self._connect().execute(
+            "SELECT key, SUM(count) AS total FROM rollups "
+            "WHERE scope = ? AND dimension = ? AND hour >= ? "
+            "GROUP BY key ORDER BY total DESC LIMIT ?",
+            (scope, dimension, since, limit)).fetchall()
@@ -1,17 +1,21 @@
 import asyncio
 import io
+import itertools
+import json
 import math
 import re
 import urllib.parse
 from datetime import datetime
 
-import aiohttp
 import discord.game
 import pytz
 from PIL import Image
 from lxml import html
 from pytz import timezone
 
+import discordant.analytics as analytics
+import discordant.corpus as corpus
+import discordant.upstream as upstream
 import discordant.utils as utils
 from discordant import Discordant
 
@@ -62,7 +66,7 @@ async def _help(self, args, message):
         if not msg:
             msg = await self.send_message(
                 message.channel, "Check your PMs.")
-        await _delete_after(self, 5, [message, msg])
+        _delete_after(self, 5, [message, msg])
 
 
 def _help_menu(sections):
@@ -76,6 +80,88 @@ def _help_menu(sections):
     return output
 
 
+@Discordant.register_command("top")
+async def _top(self, args, message):
+    """!top [commands/queries/channels] [days]
+    displays the most used commands, queries or channels in this server."""
+    split = args.split()
+    dimension = split[0] if split else "commands"
+    days = split[1] if len(split) > 1 else "7"
+    if dimension not in analytics.DIMENSIONS or not days.isdigit():
+        await utils.send_help(self, message, "top")
+        return
+    await self.analytics.flush()
+    rows = await self.analytics.top(
+        analytics.message_scope(message), dimension, 10, int(days))
+    if not rows:
+        await self.send_message(message.channel, "No usage recorded.")
+        return
+
+    def display_key(key):
+        if dimension != "channels" or key == "private":
+            return key
+        return "<#{}>".format(key)
+
+    output = "**top {} (last {} days)**:\n".format(dimension, days)
+    output += "\n".join(["{}. {} ({})".format(i + 1, display_key(key), count)
+                         for i, (key, count) in enumerate(rows)])
+    await self.send_message(message.channel, output)
+
+
+@Discordant.register_command("stats")
+async def _stats(self, args, message):
+    """!stats
+    displays bot usage statistics and upstream site health."""
+    cache = self.lookup_cache
+    output = "**stats**:\n{} commands parsed.\n".format(self.commands_parsed)
+    output += "Lookup cache: {} entries ({} KB), {} hits, {} misses, " \
+              "{} shared.\n".format(len(cache), cache.bytes // 1024,
+                                    cache.hits, cache.misses, cache.coalesced)
+    output += "Analytics: {} recorded, {} dropped.\n".format(
+        self.analytics.recorded, self.analytics.dropped)
+    if self.upstream.sites:
+        output += "**sites**:\n" + "\n".join(
+            [site.status() for site in self.upstream.sites.values()])
+    await utils.send_long_message(self, message.channel, output)
+
+
+@Discordant.register_command("profile")
+async def _profile(self, args, message):
+    """!profile <slow> <seconds/off> or !profile <cpu/sample> <seconds>
+    (admin) reports callbacks that block the bot for longer than the given
+    threshold, or writes a cpu/sampling profile of the given length to disk."""
+    if not message.server or not utils.has_permission(
+            message.author, "administrator"):
+        await self.send_message(message.channel,
+                                "You are not allowed to use this command.")
+        return
+    split = args.split()
+    if len(split) != 2 or split[0] not in ("slow", "cpu", "sample"):
+        await utils.send_help(self, message, "profile")
+        return
+    kind, value = split
+    try:
+        if kind == "slow":
+            threshold = None if value == "off" else float(value)
+            self.profiler.watch_slow_callbacks(threshold)
+            await self.send_message(
+                message.channel, "Slow callback reporting " + (
+                    "disabled." if threshold is None else
+                    "enabled for callbacks over {}s.".format(threshold)))
+            return
+
+        def done(file):
+            asyncio.ensure_future(self.send_message(
+                message.channel, "Profile written to " + file))
+
+        self.profiler.profile(kind, float(value), done)
+    except (ValueError, RuntimeError) as e:
+        await self.send_message(message.channel, str(e))
+        return
+    await self.send_message(
+        message.channel, "Profiling for {}s.".format(value))
+
+
 def _tz_args(args):
     if not args:
         return False
@@ -148,6 +234,16 @@ async def _convert_timezone(self, args_split, message):
                                 ": Not a valid time format or time zone code.")
 
 
+async def _fetch(self, url, read="text"):
+    # urls are built from normalized queries, so the url doubles as the
+    # cache and coalescing key. json is cached as text, whose size the
+    # cache can measure, and parsed on the way out.
+    if read == "json":
+        return json.loads(await _fetch(self, url))
+    return await self.lookup_cache.get(
+        (read, url), lambda: self.upstream.fetch(url, read))
+
+
 def _search_args(args, keys=None):
     if not utils.has_args(args):
         return False
@@ -169,29 +265,42 @@ async def _jisho_search(self, args_tuple, message):
     """!jisho [limit] <query>
     searches japanese-english dictionary <http://jisho.org>.
     see <http://jisho.org/docs> for search options."""
-    limit, query = args_tuple
+    reply = _progressive_reply(self, message)
+    try:
+        output = await _jisho_lookup(self, *args_tuple,
+                                     progress=reply.update)
+    except asyncio.CancelledError:
+        raise  # an Exception before python 3.8, but not a failed lookup
+    except Exception:
+        await reply.fail()
+        raise
+    await reply.finish(output)
+
+
+def _progressive_reply(self, message):
+    return utils.ProgressiveReply(
+        self, message.channel, message.server is not None,
+        replies=self.replies(), **self.config.get("replies", {})).start()
+
+
+async def _jisho_lookup(self, limit, query, progress=None):
+    query = utils.normalize_query(query, self.config.get("lookup", {}).get(
+        "romaji_to_kana", False))
     if "#kanji" in query:
-        await _jisho_kanji(self, limit, query, message)
-        return
+        return await _jisho_kanji(self, limit, query, progress)
     if "#sentences" in query:
-        await _jisho_sentences(self, limit, query, message)
-        return
+        return await _jisho_sentences(self, limit, query)
     if "#names" in query:
-        await _jisho_names(self, limit, query, message)
-        return
+        return await _jisho_names(self, limit, query)
     url = "http://jisho.org/api/v1/search/words?keyword=" + \
           urllib.parse.quote(query, encoding="utf-8")
     try:
-        with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                data = await response.json()
+        data = await _fetch(self, url, "json")
     except Exception as e:
-        await self.send_message(message.channel, "Request failed: " + str(e))
-        return
+        return "Request failed: " + str(e)
     results = data["data"][:limit]
     if not results:
-        await self.send_message(message.channel, "No results found.")
-        return
+        return "No results found."
     output = ""
 
     def display_word(obj, *formats):
@@ -234,45 +343,44 @@ async def _jisho_search(self, args_tuple, message):
                 [display_word(x, "{}", "{word} ({reading})") for x in
                  japanese[1:]]) + "\n"
         # output += "\n"
-    await utils.send_long_message(
-        self, message.channel, output, message.server is not None)
+    return output
 
 
-async def _jisho_kanji(self, limit, query, message):
+async def _jisho_kanji(self, limit, query, progress=None):
     url = "http://jisho.org/search/" + urllib.parse.quote(
         query, encoding="utf-8")
     try:
-        with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                data = await response.text()
+        data = await _fetch(self, url)
     except Exception as e:
-        await self.send_message(message.channel, "Request failed: " + str(e))
-        return
+        return "Request failed: " + str(e)
     tree = html.fromstring(data)
     info_div = tree.xpath('//div[@class="kanji details"]')
     if info_div:
-        await self.send_message(message.channel, _jisho_kanji_info(tree))
-        return
+        return _jisho_kanji_info(tree)
     results_div = tree.xpath('//div[@class="kanji_light_block"]')
     if not results_div:
-        await self.send_message(message.channel, "No results found.")
-        return
+        return "No results found."
     results_divs = results_div[0].xpath(
         './div[@class="entry kanji_light clearfix"]')[:limit]
+    k_urls = [x.xpath('a[@class="light-details_link"]')[0].attrib["href"]
+              for x in results_divs]
+    # fetch every kanji at once, but report them in order as they arrive
+    fetches = [asyncio.ensure_future(_fetch(self, x)) for x in k_urls]
     output = ""
-    for result_div in results_divs:
-        k_url = result_div.xpath(
-            'a[@class="light-details_link"]')[0].attrib["href"]
-        try:
-            with aiohttp.ClientSession() as session:
-                async with session.get(k_url) as response:
-                    k_data = await response.text()
-        except Exception as e:
-            output += "Request failed: {}, {}".format(k_url, e) + "\n"
-            continue
-        output += _jisho_kanji_info(html.fromstring(k_data)) + "\n"
-    await utils.send_long_message(
-        self, message.channel, output, message.server is not None)
+    try:
+        for k_url, fetch in zip(k_urls, fetches):
+            try:
+                k_data = await fetch
+            except Exception as e:
+                output += "Request failed: {}, {}".format(k_url, e) + "\n"
+                continue
+            output += _jisho_kanji_info(html.fromstring(k_data)) + "\n"
+            if progress:
+                await progress(output)
+    finally:
+        for fetch in fetches:
+            fetch.cancel()
+    return output
 
 
 def _jisho_kanji_info(tree):
@@ -298,49 +406,50 @@ def _jisho_kanji_info(tree):
     return "**{}** {}\n*{}. {}*\n{}\n{}\n{}".format(
         character, meanings, strokes, stats, readings, radical, parts)
 
-async def _jisho_sentences(self, limit, query, message, sentence_url=None):
-    url = sentence_url or "http://jisho.org/search/" + urllib.parse.quote(
-        query, encoding="utf-8")
+
+async def _jisho_sentences(self, limit, query, sentence_url=None):
     try:
-        with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                data = await response.text()
+        sentences = await _jisho_sentence_list(
+            self, limit, query, sentence_url)
     except Exception as e:
-        await self.send_message(message.channel, "Request failed: " + str(e))
-        return
-    tree = html.fromstring(data)
-    sentences = tree.xpath('//ul[@class="sentences"]') or tree.xpath(
-        '//article[@class="sentences columns small-8"]')
+        return "Request failed: " + str(e)
     if not sentences:
-        await self.send_message(message.channel, "No results found.")
-        return
-    sentences = sentences[0][:limit]
+        return "No results found."
     fmt = ("**{i}.** " if len(sentences) > 1 else "") + "{jp}。{en}\n"
     output = ""
-    for i, li in enumerate(sentences):
+    for i, (japanese, english) in enumerate(sentences):
+        output += fmt.format(jp=japanese, en=english, i=i+1)
+    return output
+
+
+async def _jisho_sentence_list(self, limit, query, sentence_url=None):
+    url = sentence_url or "http://jisho.org/search/" + urllib.parse.quote(
+        query, encoding="utf-8")
+    tree = html.fromstring(await _fetch(self, url))
+    sentences = tree.xpath('//ul[@class="sentences"]') or tree.xpath(
+        '//article[@class="sentences columns small-8"]')
+    if not sentences:
+        return []
+    output = []
+    for li in sentences[0][:limit]:
         div = li.xpath('div[@class="sentence_content"]')[0]
         japanese = "".join(div.xpath('ul/li/span[@class="unlinked"]/text()'))
         english = div[1][0].text_content()
-        output += fmt.format(jp=japanese, en=english, i=i+1)
-    await utils.send_long_message(
-        self, message.channel, output, message.server is not None)
+        output.append((japanese, english))
+    return output
 
 
-async def _jisho_names(self, limit, query, message):
+async def _jisho_names(self, limit, query):
     url = "http://jisho.org/search/" + urllib.parse.quote(
         query, encoding="utf-8")
     try:
-        with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                data = await response.text()
+        data = await _fetch(self, url)
     except Exception as e:
-        await self.send_message(message.channel, "Request failed: " + str(e))
-        return
+        return "Request failed: " + str(e)
     tree = html.fromstring(data)
     names = tree.xpath('//div[@class="names"]')
     if not names:
-        await self.send_message(message.channel, "No results found.")
-        return
+        return "No results found."
     names = names[0].xpath("div")[:limit]
     output = ""
     for div in names:
@@ -351,37 +460,45 @@ async def _jisho_names(self, limit, query, message):
         tags = utils.remove_spaces(info_div[0].text_content())
         meaning = utils.remove_spaces(info_div[1].text_content())
         output += "{}\n*{}.*\n{}\n".format(name, tags, meaning)
-    await utils.send_long_message(
-        self, message.channel, output, message.server is not None)
+    return output
 
 
 @Discordant.register_command("alc", arg_func=_search_args)
 async def _alc_search(self, args_tuple, message):
     """!alc [limit] <query>
     searches english-japanese dictionary <http://alc.co.jp>."""
-    limit, query = args_tuple
+    reply = _progressive_reply(self, message)
+    try:
+        output = await _alc_lookup(self, *args_tuple)
+    except asyncio.CancelledError:
+        raise  # an Exception before python 3.8, but not a failed lookup
+    except Exception:
+        await reply.fail()
+        raise
+    await reply.finish(output)
+
+
+async def _alc_lookup(self, limit, query):
+    query = utils.normalize_query(query)
     url = "http://eow.alc.co.jp/search?q=" + \
           urllib.parse.quote(
               re.sub(r"\s+", "+", query), encoding="utf-8", safe="+")
     try:
-        with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                data = await response.text()
+        data = await _fetch(self, url)
     except Exception as e:
-        await self.send_message(message.channel, "Request failed: " + str(e))
-        return
+        return "Request failed: " + str(e)
     output = ""
     tree = html.fromstring(data)
     results = tree.xpath('//div[@id="resultsList"]/ul/li')[:limit]
     if not results:
-        await self.send_message(message.channel, "No results found.")
-        return
+        return "No results found."
+    highlight = utils.highlight_pattern(tuple(tree.xpath(
+        '//div[@id="resultsList"]/ul/li/span[starts-with(@class, "midashi")]'
+        '/h2/span[@class="redtext"]/text()')))
     for result in results:
         words = [x for x in result.xpath('./span') if
                  x.attrib["class"].startswith("midashi")][0]
-        highlight = " ".join(words.xpath('./h2/span[@class="redtext"]/text()'))
-        output += re.sub("(" + highlight + ")", r"**\1**",
-                         words.text_content()) + "\n"
+        output += utils.highlight(words.text_content(), highlight) + "\n"
         div = result.xpath('./div')[0]
         if div.xpath('./text()') or div.xpath('./span[@class="refvocab"]'):
             output += div.text_content()
@@ -408,49 +525,74 @@ async def _alc_search(self, args_tuple, message):
         # cheap ass fuckers dont actually give 文例's
         # also removes kana things
         output = re.sub(r"(｛[^｝]*｝)|(【文例】)", "", output.strip()) + "\n"
-    await utils.send_long_message(
-        self, message.channel, output, message.server is not None)
+    return output
 
 
-async def _dict_search_link(self, match, message, cmd, group):
-    query = urllib.parse.unquote(match.group(group), encoding="utf-8")
-    args_tuple = (1, query) + (([],) if cmd in ("yourei", "nyanglish") else ())
-    await getattr(self, utils.get_cmd(self, cmd).name)(args_tuple, message)
+async def _dict_search_link(self, match, cmd, group):
+    # alc puts "+" for spaces in its urls
+    unquote = urllib.parse.unquote_plus if cmd == "alc" else \
+        urllib.parse.unquote
+    query = unquote(match.group(group), encoding="utf-8")
+    if cmd == "jisho":
+        return await _jisho_lookup(self, 1, query)
+    if cmd == "alc":
+        return await _alc_lookup(self, 1, query)
+    return await _example_sentence_search(
+        self, (1, query, {}), cmd, "http://{}/".format(match.group(1)))
 
 
 @Discordant.register_handler(
-    r"http:\/\/jisho\.org\/(search|word|sentences)\/(\S*)")
-async def _jisho_link(self, match, message):
+    r"http:\/\/jisho\.org\/(search|word|sentences)\/(\S*)", batch=True)
+async def _jisho_link(self, match):
     if match.group(1) == "sentences":
-        await _jisho_sentences(self, 1, "", message, match.group(0))
-    else:
-        await _dict_search_link(self, match, message, "jisho", 2)
+        return await _jisho_sentences(self, 1, "", match.group(0))
+    return await _dict_search_link(self, match, "jisho", 2)
 
 
-@Discordant.register_handler(r"http:\/\/eow\.alc\.co\.jp\/search\?q=([^\s&]*)")
-async def _alc_link(self, match, message):
-    await _dict_search_link(self, match, message, "alc", 1)
+@Discordant.register_handler(
+    r"http:\/\/eow\.alc\.co\.jp\/search\?q=([^\s&]*)", batch=True)
+async def _alc_link(self, match):
+    return await _dict_search_link(self, match, "alc", 1)
 
 
-async def _example_sentence_search(self, args_tuple, message, cmd, url):
+async def _example_sentence_search(self, args_tuple, cmd, url):
     limit, query, kwargs = args_tuple
-    context = kwargs["context"].lower() in ("true", "t", "yes", "y", "1") \
-        if "context" in kwargs else False
-    url = url + urllib.parse.quote(re.sub(r"\s+", "-", query), encoding="utf-8")
     try:
-        with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                data = await response.text()
+        results = await _example_sentence_list(
+            self, limit, query, _context_kwarg(kwargs), cmd, url)
     except Exception as e:
-        await self.send_message(message.channel, "Request failed: " + str(e))
-        return
-    tree = html.fromstring(data)
+        return "Request failed: " + str(e)
+    if not results:
+        return "No results found."
+    return "\n".join([(str(index + 1) + ". " if len(
+        results) > 1 else "") + result for index, result in
+                      enumerate(results)])
+
+
+def _context_kwarg(kwargs):
+    return kwargs["context"].lower() in ("true", "t", "yes", "y", "1") \
+        if "context" in kwargs else False
+
+
+async def _example_sentence_list(self, limit, query, context, cmd, url):
+    query = utils.normalize_query(query)
+    if self.corpus and not context:
+        # the remote site is only a fallback for the local corpus, which
+        # has no surrounding sentences to give as context
+        results = await self.loop.run_in_executor(
+            None, _corpus_sentence_list, self, limit, query, cmd == "yourei")
+        if results:
+            return results
+    url = url + urllib.parse.quote(re.sub(r"\s+", "-", query), encoding="utf-8")
+    tree = html.fromstring(await _fetch(self, url))
     query = '//li[contains(@class, "sentence") and span[@class="the-sentence"]]'
     results = tree.xpath(query)[:limit]
-    if not results:
-        await self.send_message(message.channel, "No results found.")
-        return
     japanese = cmd == "yourei"
+    # the page's first script carries the js regex the site highlights with
+    script = tree.xpath("//script[1]/text()")
+    match = re.search(r'"([^"]*)"', script[0]) if script else None
+    highlight = utils.highlight_pattern(
+        (match.group(1).replace("\\\\", "\\"),), False) if match else None
 
     def sentence_text(element, class_prefix="the"):
         lst = element.xpath('span[@class="' + class_prefix + '-sentence"]')
@@ -458,22 +600,27 @@ async def _example_sentence_search(self, args_tuple, message, cmd, url):
             lst[0].xpath("text() | */text()")) if lst else ""
 
     def result_text(element):
-        text = sentence_text(element)
-        match = re.search(r'"([^"]*)"', tree.xpath("//script[1]/text()")[0])
-        pattern = match.group(1).replace("\\\\", "\\")
-        text = re.sub(pattern, r"**\1**", text, flags=re.I)
+        text = utils.highlight(sentence_text(element), highlight)
         if context:
             sentences = [x for x in [sentence_text(element, "prev"), text,
                                      sentence_text(element, "next")] if x]
             text = ("" if japanese else " ").join(sentences)
         return text
 
-    await utils.send_long_message(
-        self, message.channel,
-        "\n".join([(str(index + 1) + ". " if len(
-            results) > 1 else "") + result_text(result) for index, result in
-                   enumerate(results)]),
-        message.server is not None)
+    return [result_text(result) for result in results]
+
+
+def _corpus_sentence_list(self, limit, query, japanese):
+    side = 0 if japanese else 1
+    if japanese:
+        highlight = utils.highlight_pattern(("".join(query.split()),))
+    else:
+        # whole words only, the same way the corpus matched them
+        highlight = utils.highlight_pattern(tuple(
+            r"\b{}\b".format(re.escape(x))
+            for x in corpus.english_keys(query)), False)
+    return [utils.highlight(self.corpus.sentence(x)[side], highlight)
+            for x in self.corpus.search(query, limit, japanese)]
 
 
 def _search_args_context(args):
@@ -484,67 +631,245 @@ def _search_args_context(args):
 async def _yourei_search(self, args_tuple, message):
     """!yourei [limit] <query> [context=bool]
     searches japanese example sentences from <http://yourei.jp>."""
-    await _example_sentence_search(
-        self, args_tuple, message, "yourei", "http://yourei.jp/")
+    await utils.send_long_message(
+        self, message.channel, await _example_sentence_search(
+            self, args_tuple, "yourei", "http://yourei.jp/"),
+        message.server is not None)
 
 
 @Discordant.register_command("nyanglish", arg_func=_search_args_context)
 async def _nyanglish_search(self, args_tuple, message):
     """!nyanglish [limit] <query> [context=bool]
     searches english example sentences from <http://nyanglish.com>."""
-    await _example_sentence_search(
-        self, args_tuple, message, "nyanglish", "http://nyanglish.com/")
+    await utils.send_long_message(
+        self, message.channel, await _example_sentence_search(
+            self, args_tuple, "nyanglish", "http://nyanglish.com/"),
+        message.server is not None)
+
+
+@Discordant.register_handler(
+    r"http:\/\/(yourei\.jp|nyanglish\.com)\/(\S+)", batch=True)
+async def _yourei_link(self, match):
+    return await _dict_search_link(
+        self, match, match.group(1).split(".")[0], 2)
+
+
+async def _yourei_examples(self, limit, query, context):
+    return await _example_sentence_list(
+        self, limit, query, context, "yourei", "http://yourei.jp/")
+
 
+async def _nyanglish_examples(self, limit, query, context):
+    return await _example_sentence_list(
+        self, limit, query, context, "nyanglish", "http://nyanglish.com/")
 
-@Discordant.register_handler(r"http:\/\/(yourei\.jp|nyanglish\.com)\/(\S+)")
-async def _yourei_link(self, match, message):
-    await _dict_search_link(
-        self, match, message, match.group(1).split(".")[0], 2)
 
+async def _jisho_examples(self, limit, query, context):
+    query = utils.normalize_query(query)
+    highlight = utils.highlight_pattern(tuple(query.split()))
+    return [utils.highlight(japanese, highlight) + "。" + english
+            for japanese, english in await _jisho_sentence_list(
+                self, limit, query + " #sentences")]
 
-async def _delete_after(self, time, args):
-    await asyncio.sleep(time)
-    f = getattr(
-        self, "delete_message" + ("s" if isinstance(args, list) else ""))
-    await f(args)
+
+_EXAMPLE_SOURCES = [("yourei", _yourei_examples),
+                    ("jisho", _jisho_examples),
+                    ("nyanglish", _nyanglish_examples)]
+
+
+async def _example_source(self, name, func, limit, query, context):
+    # each source runs in a task of its own, so it needs its own tag
+    self.profiler.tag("!examples {} {}".format(name, query))
+    try:
+        return await func(self, limit, query, context)
+    except upstream.NotFound:
+        return []  # the site answered, it just has nothing for the query
+
+
+@Discordant.register_command("examples", ["ex"],
+                             arg_func=_search_args_context)
+async def _examples_search(self, args_tuple, message):
+    """!examples [limit] <query> [context=bool]
+    searches every example sentence source at once, and shows whatever
+    has arrived within a few seconds."""
+    limit, query, kwargs = args_tuple
+    context = _context_kwarg(kwargs)
+    config = self.config.get("examples", {})
+    tasks = [asyncio.ensure_future(asyncio.wait_for(
+        _example_source(self, name, func, limit, query, context),
+        config.get("source_deadline", 3)))
+             for name, func in _EXAMPLE_SOURCES]
+    done, pending = await asyncio.wait(tasks,
+                                       timeout=config.get("deadline", 4))
+    for task in pending:
+        task.cancel()
+    results = []
+    missing = []  # sources that timed out or failed, not empty ones
+    for (name, _), task in zip(_EXAMPLE_SOURCES, tasks):
+        if task in done and not task.exception():
+            results.append(task.result())
+        else:
+            missing.append(name)
+    # take from each source in turn, so one verbose site can't crowd out
+    # the others
+    sentences = []
+    seen = set()
+    for sentence in itertools.chain.from_iterable(
+            itertools.zip_longest(*results)):
+        key = re.sub(r"\*\*|\s", "", sentence or "").casefold()
+        if key and key not in seen:
+            seen.add(key)
+            sentences.append(sentence)
+    sentences = sentences[:limit]
+    output = "\n".join([(str(index + 1) + ". " if len(
+        sentences) > 1 else "") + sentence for index, sentence in
+                        enumerate(sentences)]) or "No results found."
+    if missing:
+        output += "\n*No answer from {}.*".format(", ".join(missing))
+    await utils.send_long_message(
+        self, message.channel, output, message.server is not None)
+
+
+def _delete_after(self, time, args):
+    messages = args if isinstance(args, list) else [args]
+    self.scheduler.schedule(
+        time, ("delete", messages[0].channel.id),
+        lambda x: _delete_messages(self, x), messages)
+
+
+@Discordant.register_event("message_delete")
+async def _cancel_deleted_command(self, message):
+    replies = self.cancel_command(message.id)
+    if replies:
+        # whatever the cancelled command got out is an orphan now, and so
+        # is anything left from the run it was re-running after an edit
+        await _delete_replies(self, replies.all())
+
+
+@Discordant.register_event("message_edit")
+async def _rerun_edited_command(self, before, after):
+    if before.content == after.content or after.author == self.user:
+        return  # e.g. discord adding a link preview
+    replies = self.cancel_command(after.id)
+    previous = replies.all() if replies else self.pop_replies(after.id)
+    if not after.content.startswith(self.command_char):
+        await _delete_replies(self, previous)
+    elif replies or previous:
+        await self.run_command(after, previous)
+
+
+async def _delete_replies(self, messages):
+    # e.g. !help replies both in the channel and in a private message
+    channels = {}
+    for reply in messages:
+        channels.setdefault(reply.channel.id, []).append(reply)
+    for channel_messages in channels.values():
+        await _delete_messages(self, channel_messages)
+
+
+async def _delete_messages(self, messages):
+    # bulk deletes only take 2-100 messages, and not in private channels
+    if messages[0].channel.is_private:
+        chunks = [[x] for x in messages]
+    else:
+        chunks = [messages[i:i + 100] for i in range(0, len(messages), 100)]
+    for chunk in chunks:
+        try:
+            if len(chunk) > 1:
+                await self.delete_messages(chunk)
+            else:
+                await self.delete_message(chunk[0])
+        except discord.errors.HTTPException:
+            pass  # already deleted, or not ours to delete
 
 
 @Discordant.register_command("strokeorder", ["so"], arg_func=utils.has_args)
 async def _stroke_order(self, args, message):
-    """!strokeorder <character>
-    shows stroke order for a kanji character."""
-    file = str(ord(args[0])) + "_frames.png"
-    url = "http://classic.jisho.org/static/images/stroke_diagrams/" + file
-    try:
-        with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status == 404:
-                    await self.send_message(message.channel,
-                                            args[0] + ": Kanji not found.")
-                    return
-                raw_response = await response.read()
-    except Exception as e:
-        await self.send_message(message.channel, "Request failed: " + str(e))
+    """!strokeorder <characters>
+    shows stroke order for one or more kanji characters."""
+    max_chars = self.config.get("strokeorder", {}).get("max_characters", 5)
+    chars = []
+    for char in "".join(args.split()):
+        if char not in chars:
+            chars.append(char)
+    if len(chars) > max_chars:
+        await self.send_message(
+            message.channel,
+            "Too many characters (maximum {}).".format(max_chars))
         return
-    orig_image = Image.open(io.BytesIO(raw_response))
-    image = _crop_and_shift_img(orig_image)
+    results = await asyncio.gather(
+        *[_stroke_order_fetch(self, char) for char in chars],
+        return_exceptions=True)
+    images = []
+    errors = []
+    for char, result in zip(chars, results):
+        if isinstance(result, upstream.NotFound):
+            errors.append(char + ": Kanji not found.")
+        elif isinstance(result, Exception):
+            errors.append(char + ": Request failed: " + str(result))
+        else:
+            images.append(result)
+    if errors:
+        await self.send_message(message.channel, "\n".join(errors))
+    if not images:
+        return
+    config = self.config.get("strokeorder", {})
+    fmt = config.get("format", "png")
+    # pillow holds the gil for the whole encode, keep it off the loop
+    buffer, extension = await self.loop.run_in_executor(
+        None, lambda: _encode_img(
+            _crop_and_shift_img(*images, mode=_IMAGE_MODES.get(fmt, "RGBA")),
+            fmt, config.get("colors", 8)))
+    await self.send_file(
+        message.channel, buffer, filename="_".join(
+            str(ord(x)) for x in chars) + "_frames." + extension)
+
+
+async def _stroke_order_fetch(self, char):
+    url = "http://classic.jisho.org/static/images/stroke_diagrams/" + \
+          str(ord(char)) + "_frames.png"
+    return Image.open(io.BytesIO(await _fetch(self, url, "read")))
+
+
+# canvas mode to build each output format's image in
+_IMAGE_MODES = {"grayscale": "LA"}
+
+
+def _encode_img(img, fmt="png", colors=8):
+    # the diagrams are two-tone line drawings, so the compact formats lose
+    # nothing visible. see bench_strokeorder.py for size/time tradeoffs.
     buffer = io.BytesIO()
-    image.save(buffer, format="PNG")
+    extension = "png"
+    if fmt == "palette":
+        img.quantize(colors, method=Image.FASTOCTREE).save(
+            buffer, format="PNG", optimize=True)
+    elif fmt == "grayscale":
+        img.convert("LA").save(buffer, format="PNG", optimize=True)
+    elif fmt == "webp":
+        img.save(buffer, format="WEBP", lossless=True, quality=100, method=4)
+        extension = "webp"
+    else:
+        img.save(buffer, format="PNG")
     buffer.seek(0)
-    await self.send_file(message.channel, buffer, filename=file)
+    return buffer, extension
 
 
-def _crop_and_shift_img(img):
+def _crop_and_shift_img(*imgs, mode="RGBA"):
+    # each image's frames are wrapped onto rows of their own, and the
+    # images are stacked on top of each other.
     char_width = 109  # width/height of one character
     chars_per_line = 4  # max before discord starts resizing it
     max_width = char_width * chars_per_line
-    slices = int(math.ceil(img.width / max_width))
-    total_height = char_width * slices
-    width = min(max_width, img.width)
-    new_img = Image.new("RGBA", (width, total_height), color=(0, 0, 0, 0))
-    for i in range(slices):
-        left = i * max_width
-        right = min(left + max_width, img.width)
-        _slice = img.crop((left, 0, right, char_width))
-        new_img.paste(_slice, (0, char_width * i))
+    slices = [int(math.ceil(img.width / max_width)) for img in imgs]
+    total_height = char_width * sum(slices)
+    width = min(max_width, max(img.width for img in imgs))
+    new_img = Image.new(mode, (width, total_height))
+    row = 0
+    for img, img_slices in zip(imgs, slices):
+        for i in range(img_slices):
+            left = i * max_width
+            right = min(left + max_width, img.width)
+            _slice = img.crop((left, 0, right, char_width))
+            new_img.paste(_slice, (0, char_width * row))
+            row += 1
     return new_img
@@ -0,0 +1,231 @@
+"""Local bilingual example sentence corpus with an on-disk inverted index.
+
+Build an index from a tab separated file of japanese/english pairs, either
+two columns (japanese, english) or a Tatoeba sentence pairs export (id,
+japanese, id, english):
+
+    python -m discordant.corpus <pairs.tsv> <index file>
+
+The index is a single file that is memory-mapped at runtime:
+
+    header      magic, sentence count, key count, section offsets
+    keys        (key hash, first posting, posting count), sorted by hash
+    postings    sentence ids for each key, ascending
+    offsets     start of each sentence in data, plus one past the end
+    data        utf-8 "japanese\\tenglish" for each sentence
+
+Japanese text is keyed on character bigrams (and single characters),
+english on words. Keys are
+stored as 64-bit hashes, and every candidate is checked against the query,
+so a hash collision can only cost time, never a wrong result.
+"""
+import hashlib
+import mmap
+import re
+import struct
+import sys
+import unicodedata
+from array import array
+
+_MAGIC = b"JPCORP1\0"
+_HEADER = struct.Struct("<8sIIQQQQ")
+_KEY = struct.Struct("<QII")
+_OFFSET = struct.Struct("<Q")
+
+_JAPANESE_REGEX = re.compile(r"[\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff]")
+_WORD_REGEX = re.compile(r"[a-z0-9']+")
+
+
+def _normalize(text):
+    return unicodedata.normalize("NFKC", text).casefold()
+
+
+def _hash(key):
+    return int.from_bytes(
+        hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(),
+        "little")
+
+
+def is_japanese(text):
+    return bool(_JAPANESE_REGEX.search(text))
+
+
+def japanese_keys(text, unigrams=False):
+    # the index holds unigrams too, so that single character queries work
+    text = "".join(_normalize(text).split())
+    if len(text) == 1:
+        return {text}
+    keys = {text[i:i + 2] for i in range(len(text) - 1)}
+    if unigrams:
+        keys.update(text)
+    return keys
+
+
+def english_keys(text):
+    return set(_WORD_REGEX.findall(_normalize(text)))
+
+
+def build(pairs, file):
+    """Write an index for the given (japanese, english) pairs to file.
+
+    A sentence with several translations (a Tatoeba export has a row for
+    each) is only indexed on its first pair, so searches on either side
+    never return the same sentence twice."""
+    postings = {}
+    data = bytearray()
+    offsets = []
+    seen_japanese, seen_english = set(), set()
+    for japanese, english in pairs:
+        keys = set()
+        if japanese not in seen_japanese:
+            seen_japanese.add(japanese)
+            keys |= japanese_keys(japanese, True)
+        if english not in seen_english:
+            seen_english.add(english)
+            keys |= english_keys(english)
+        if not keys:
+            continue
+        sentence_id = len(offsets)
+        for key in keys:
+            postings.setdefault(_hash(key), array("I")).append(sentence_id)
+        offsets.append(len(data))
+        data += "{}\t{}".format(japanese, english).encode("utf-8")
+    offsets.append(len(data))
+
+    keys = bytearray()
+    posting_data = array("I")
+    for key_hash in sorted(postings):
+        keys += _KEY.pack(key_hash, len(posting_data), len(postings[key_hash]))
+        posting_data.extend(postings[key_hash])
+    posting_bytes = posting_data.tobytes() if sys.byteorder == "little" \
+        else _swapped(posting_data)
+
+    keys_offset = _HEADER.size
+    postings_offset = keys_offset + len(keys)
+    offsets_offset = postings_offset + len(posting_bytes)
+    data_offset = offsets_offset + _OFFSET.size * len(offsets)
+    with open(file, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, len(offsets) - 1, len(postings),
+                             keys_offset, postings_offset, offsets_offset,
+                             data_offset))
+        f.write(keys)
+        f.write(posting_bytes)
+        f.write(b"".join(_OFFSET.pack(x) for x in offsets))
+        f.write(data)
+
+
+def _swapped(arr):
+    arr = array(arr.typecode, arr)
+    arr.byteswap()
+    return arr.tobytes()
+
+
+def read_pairs(file):
+    with open(file, encoding="utf-8") as f:
+        for line in f:
+            split = line.rstrip("\n").split("\t")
+            if len(split) >= 4:
+                yield split[1], split[3]
+            elif len(split) == 2:
+                yield split[0], split[1]
+
+
+class Corpus:
+    """Read-only view of an index written by build()."""
+
+    def __init__(self, file):
+        self._file = open(file, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.sentences, self._keys, self._keys_offset,
+         self._postings_offset, self._offsets_offset,
+         self._data_offset) = _HEADER.unpack_from(self._map, 0)
+        if magic != _MAGIC:
+            raise ValueError(file + ": not a sentence index")
+
+    def __len__(self):
+        return self.sentences
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def _postings(self, key):
+        key_hash = _hash(key)
+        low, high = 0, self._keys
+        while low < high:
+            mid = (low + high) // 2
+            mid_hash, start, count = _KEY.unpack_from(
+                self._map, self._keys_offset + mid * _KEY.size)
+            if mid_hash < key_hash:
+                low = mid + 1
+            elif mid_hash > key_hash:
+                high = mid
+            else:
+                start = self._postings_offset + start * 4
+                postings = array("I")
+                postings.frombytes(self._map[start:start + count * 4])
+                if sys.byteorder != "little":
+                    postings.byteswap()
+                return postings
+        return array("I")
+
+    def sentence(self, sentence_id):
+        """Return the (japanese, english) pair with the given id."""
+        start, end = struct.unpack_from(
+            "<QQ", self._map, self._offsets_offset + sentence_id * 8)
+        return tuple(self._map[self._data_offset + start:
+                               self._data_offset + end]
+                     .decode("utf-8").split("\t", 1))
+
+    def search(self, query, limit, japanese=None):
+        """Return ids of up to limit sentences matching the query.
+
+        Japanese queries match as a substring of the japanese side, english
+        ones match every word on the english side. japanese picks the side
+        explicitly; by default it's guessed from the query."""
+        query = _normalize(query)
+        if japanese is None:
+            japanese = is_japanese(query)
+        keys = japanese_keys(query) if japanese else english_keys(query)
+        if not keys:
+            return []
+        postings = sorted((self._postings(x) for x in keys), key=len)
+        if not postings[0]:
+            return []
+        candidates = set(postings[0])
+        for other in postings[1:]:
+            candidates.intersection_update(other)
+            if not candidates:
+                return []
+        if japanese:
+            needle = "".join(query.split())
+
+            def matches(pair):
+                return needle in "".join(_normalize(pair[0]).split())
+        else:
+            words = english_keys(query)
+
+            def matches(pair):
+                return words <= english_keys(pair[1])
+
+        results = []
+        for sentence_id in sorted(candidates):
+            if matches(self.sentence(sentence_id)):
+                results.append(sentence_id)
+                if len(results) >= limit:
+                    break
+        return results
+
+
+def main():
+    if len(sys.argv) != 3:
+        print("usage: python -m discordant.corpus <pairs.tsv> <index file>")
+        sys.exit(-1)
+    build(read_pairs(sys.argv[1]), sys.argv[2])
+    corpus = Corpus(sys.argv[2])
+    print("Indexed {} sentences.".format(len(corpus)))
+    corpus.close()
+
+
+if __name__ == '__main__':
+    main()
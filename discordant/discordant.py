@@ -1,9 +1,11 @@
 import asyncio
 import json
+import os
 import re
 import sys
 import traceback
-from collections import namedtuple
+import weakref
+from collections import OrderedDict, namedtuple
 from inspect import iscoroutinefunction
 from os import path
 
@@ -11,9 +13,30 @@ import aiohttp
 import discord
 
 import discordant.utils as utils
+from discordant.analytics import Analytics, message_scope
+from discordant.corpus import Corpus
+from discordant.profiling import Profiler
+from discordant.scheduler import Scheduler
+from discordant.upstream import LookupCache, Upstream
 
 Command = namedtuple('Command', ['name', 'arg_func', 'aliases', 'section', 'help'])
 
+class Replies:
+    """The messages the bot sent in reply to one command message.
+
+    When a command is re-run after its message is edited, previous holds
+    the earlier run's text replies, which send_message edits in place
+    instead of posting new messages. Replies with attachments can't be
+    edited into anything else, so they go in stale and are replaced."""
+
+    def __init__(self, previous=()):
+        self.previous = [x for x in previous if not x.attachments]
+        self.stale = [x for x in previous if x.attachments]
+        self.sent = []
+
+    def all(self):
+        return self.previous + self.stale + self.sent
+
 
 def decorate_all_events():
     def wrapper(cls):
@@ -25,10 +48,15 @@ def decorate_all_events():
     return wrapper
 
 
+def _analytics_channel(message):
+    return message.channel.id if message.server else "private"
+
+
 @decorate_all_events()
 class Discordant(discord.Client):
     _CMD_NAME_REGEX = re.compile(r'[a-z0-9]+')
     _handlers = {}
+    _batch_handlers = set()
     _commands = {}
     _aliases = {}
     _triggers = set()
@@ -41,12 +69,38 @@ class Discordant(discord.Client):
         self.command_char = ''
         self.config = {}
         self.commands_parsed = 0
+        self._in_flight = {}  # message id -> (task, Replies)
+        self._replies = OrderedDict()  # message id -> recent reply messages
+        self._task_replies = weakref.WeakKeyDictionary()  # task -> Replies
 
         self.load_config(config_file)
+        lookup = self.config.get("lookup", {})
+        self.lookup_cache = LookupCache(
+            lookup.get("cache_ttl", 300),
+            lookup.get("cache_bytes", 8 * 1024 * 1024))
+        self.upstream = Upstream(self.config.get("upstream"))
+        self.analytics = Analytics(**self.config.get("analytics", {}))
+        self.scheduler = Scheduler(self.loop)
+        self.corpus = None
+        corpus_file = self.config.get("corpus", {}).get("path")
+        if corpus_file:
+            if path.exists(corpus_file):
+                self.corpus = Corpus(corpus_file)
+            else:
+                print("Sentence corpus '{}' not found,".format(corpus_file),
+                      "using remote sites only.")
+        self.profiler = Profiler(self.loop, **self.config.get("profile", {}))
+        if os.environ.get("DISCORDANT_SLOW_CALLBACK"):
+            self.profiler.watch_slow_callbacks(
+                float(os.environ["DISCORDANT_SLOW_CALLBACK"]))
 
     def run(self):
         super().run(self._token)
 
+    async def close(self):
+        await self.analytics.stop()
+        await super().close()
+
     def load_config(self, config_file):
         if utils.is_url(config_file):
             async def f():
@@ -84,6 +138,8 @@ class Discordant(discord.Client):
         print("Error:\n" + utils.python_format(traceback.format_exc()), file=sys.stderr)
 
     async def on_ready(self):
+        self.analytics.start(self.loop)
+        self.scheduler.start()
         await self.change_presence(
             game=discord.Game(name=self.config["client"]["game"])
             if self.config["client"]["game"] else None)
@@ -94,15 +150,61 @@ class Discordant(discord.Client):
             await self.run_command(message)
             return
 
+        batch = []
         for handler_name, trigger in self._handlers.items():
+            if handler_name in self._batch_handlers:
+                batch.extend((handler_name, match) for match in
+                             trigger.finditer(message.content))
+                continue
             match = trigger.search(message.content)
             if match:
+                self._record_trigger(handler_name, match, message)
                 await getattr(self, handler_name)(match, message)
-            # for match in trigger.finditer(message.content):
-            #     await getattr(self, handler_name)(match, message)
-            # the spam potential of this is too high...
-
-    async def run_command(self, message):
+        if batch:
+            await self.run_batch_handlers(batch, message)
+
+    async def run_batch_handlers(self, matches, message):
+        # answering every match separately has too much spam potential, so
+        # batch handlers return their output instead of sending it, and all
+        # the matches in a message are answered together in one reply.
+        seen = set()
+        unique = []
+        for handler_name, match in sorted(matches,
+                                          key=lambda x: x[1].start()):
+            if match.group(0) not in seen:
+                seen.add(match.group(0))
+                unique.append((handler_name, match))
+        unique = unique[:self.config["commands"].get("max_links", 3)]
+        outputs = await asyncio.gather(
+            *[self._run_batch_handler(handler_name, match, message)
+              for handler_name, match in unique])
+        output = []
+        for result in outputs:
+            if result and result.strip() not in output:
+                output.append(result.strip())
+        if output:
+            await utils.send_long_message(
+                self, message.channel, "\n".join(output),
+                message.server is not None)
+
+    async def _run_batch_handler(self, handler_name, match, message):
+        # gather runs this in a task of its own, which is the one to tag
+        self._record_trigger(handler_name, match, message)
+        try:
+            return await getattr(self, handler_name)(match)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # one broken link shouldn't cost the others their answers
+            await self.on_error(handler_name, match, message)
+
+    def _record_trigger(self, handler_name, match, message):
+        self.analytics.record(
+            handler_name[5:].strip("_"), match.group(0),
+            _analytics_channel(message), message_scope(message))
+        self.profiler.tag(handler_name + " " + match.group(0))
+
+    async def run_command(self, message, previous_replies=()):
         split = message.content.split(None, 1)
         cmd_name = split[0][1:]
         args = split[1] if len(split) > 1 else ""
@@ -110,19 +212,99 @@ class Discordant(discord.Client):
         if cmd_name in self._aliases:
             self.commands_parsed += 1
             cmd = self._commands[self._aliases[cmd_name]]
-            params = [args, message]
-            if cmd.arg_func:
-                res = cmd.arg_func(args)
-                if isinstance(res, tuple):
-                    params[0] = res[1]
-                    res = res[0]
-                if not res:
-                    await self.send_message(message.channel, cmd.help)
-                    return
-            await getattr(self, cmd.name)(*params)
+            self.analytics.record(cmd.aliases[0], args,
+                                  _analytics_channel(message),
+                                  message_scope(message))
+            # run in a task of its own so that deleting or editing the
+            # message can cancel it (see cancel_command)
+            replies = Replies(previous_replies)
+            task = asyncio.ensure_future(
+                self._run_command(cmd, args, message))
+            self.track_replies(task, replies)
+            self._in_flight[message.id] = (task, replies)
+            try:
+                await asyncio.wait([task])
+            finally:
+                if self._in_flight.get(message.id, (None,))[0] is task:
+                    del self._in_flight[message.id]
+            if task.cancelled():
+                return
+            # earlier replies that this run had no use for
+            for reply in replies.previous + replies.stale:
+                try:
+                    await self.delete_message(reply)
+                except discord.errors.HTTPException:
+                    pass
+            if replies.sent:
+                self._replies[message.id] = replies.sent
+                self._replies.move_to_end(message.id)
+                while len(self._replies) > 256:
+                    self._replies.popitem(last=False)
+            task.result()
+
+    async def _run_command(self, cmd, args, message):
+        self.profiler.tag(message.content)
+        params = [args, message]
+        if cmd.arg_func:
+            res = cmd.arg_func(args)
+            if isinstance(res, tuple):
+                params[0] = res[1]
+                res = res[0]
+            if not res:
+                await self.send_message(message.channel, cmd.help)
+                return
+        await getattr(self, cmd.name)(*params)
+
+    def cancel_command(self, message_id):
+        """Cancel the command running for the given message, if any.
+
+        Returns the cancelled run's Replies, or None if nothing was running.
+        The upstream requests it was waiting on are cancelled with it unless
+        another command is waiting on the same lookup."""
+        if message_id not in self._in_flight:
+            return None
+        task, replies = self._in_flight.pop(message_id)
+        task.cancel()
+        return replies
+
+    def replies(self, task=None):
+        """Return the Replies of the command running in task, by default
+        the current one, or None if it isn't running a command."""
+        return self._task_replies.get(task or utils.current_task())
+
+    def track_replies(self, task, replies):
+        """Count messages that task sends as replies too. Commands that
+        send from a task of their own need to pass it their Replies."""
+        if replies is not None:
+            self._task_replies[task] = replies
+
+    def pop_replies(self, message_id):
+        """Forget and return the replies to a finished command message."""
+        return self._replies.pop(message_id, [])
+
+    async def send_message(self, destination, content=None, **kwargs):
+        replies = self.replies()
+        if replies is None:
+            return await super().send_message(destination, content, **kwargs)
+        if replies.previous and not kwargs.get("tts") and \
+                replies.previous[0].channel.id == destination.id:
+            reply = await self.edit_message(
+                replies.previous.pop(0), content, embed=kwargs.get("embed"))
+        else:
+            reply = await super().send_message(destination, content,
+                                               **kwargs)
+        replies.sent.append(reply)
+        return reply
+
+    async def send_file(self, destination, fp, **kwargs):
+        reply = await super().send_file(destination, fp, **kwargs)
+        replies = self.replies()
+        if replies is not None:
+            replies.sent.append(reply)
+        return reply
 
     @classmethod
-    def register_handler(cls, trigger, regex_flags=0):
+    def register_handler(cls, trigger, regex_flags=0, batch=False):
         try:
             trigger = re.compile(trigger, regex_flags)
         except re.error as err:
@@ -148,6 +330,8 @@ class Discordant(discord.Client):
 
             setattr(cls, func_name, func)
             cls._handlers[func_name] = trigger
+            if batch:
+                cls._batch_handlers.add(func_name)
 
         return wrapper
 
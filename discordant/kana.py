@@ -0,0 +1,66 @@
+import re
+
+_VOWELS = "aiueo"
+_ROWS = {
+    "": "あいうえお", "k": "かきくけこ", "g": "がぎぐげご",
+    "s": "さしすせそ", "z": "ざじずぜぞ", "t": "たちつてと",
+    "d": "だぢづでど", "n": "なにぬねの", "h": "はひふへほ",
+    "b": "ばびぶべぼ", "p": "ぱぴぷぺぽ", "m": "まみむめも",
+    "r": "らりるれろ", "y": "や\0ゆ\0よ", "w": "わ\0\0\0を",
+}
+_YOON = {
+    "ky": "き", "gy": "ぎ", "sh": "し", "sy": "し", "j": "じ", "jy": "じ",
+    "zy": "じ", "ch": "ち", "cy": "ち", "ty": "ち", "dy": "ぢ", "ny": "に",
+    "hy": "ひ", "by": "び", "py": "ぴ", "my": "み", "ry": "り",
+}
+_SMALL = {"a": "ゃ", "u": "ゅ", "o": "ょ", "e": "ぇ"}
+
+_TABLE = {}
+for _cons, _kana in _ROWS.items():
+    for _vowel, _char in zip(_VOWELS, _kana):
+        if _char != "\0":
+            _TABLE[_cons + _vowel] = _char
+for _cons, _kana in _YOON.items():
+    for _vowel, _small in _SMALL.items():
+        _TABLE[_cons + _vowel] = _kana + _small
+_TABLE.update({
+    "shi": "し", "chi": "ち", "tsu": "つ", "fu": "ふ", "ji": "じ",
+    "si": "し", "ti": "ち", "tu": "つ", "hu": "ふ", "zi": "じ", "di": "ぢ",
+    "du": "づ", "fa": "ふぁ", "fi": "ふぃ", "fe": "ふぇ", "fo": "ふぉ",
+    "wi": "うぃ", "we": "うぇ", "n'": "ん", "-": "ー",
+})
+_LONGEST = max(len(x) for x in _TABLE)
+
+_ROMAJI_REGEX = re.compile(r"^[a-z'-]+$")
+
+
+def romaji_to_kana(s):
+    """Convert a lowercase romaji word to hiragana.
+
+    Returns None if any part of the word isn't valid romaji, so english
+    words generally come back untouched by the caller."""
+    if not _ROMAJI_REGEX.match(s):
+        return None
+    output = ""
+    i = 0
+    while i < len(s):
+        # doubled consonant -> small tsu
+        if (s[i] == s[i + 1:i + 2] and s[i] not in _VOWELS + "n'-") or \
+                s[i:i + 3] == "tch":
+            output += "っ"
+            i += 1
+            continue
+        for length in range(_LONGEST, 0, -1):
+            kana = _TABLE.get(s[i:i + length])
+            if kana:
+                output += kana
+                i += length
+                break
+        else:
+            # a lone n before a consonant or at the end of the word
+            if s[i] == "n":
+                output += "ん"
+                i += 1
+            else:
+                return None
+    return output
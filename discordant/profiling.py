@@ -0,0 +1,139 @@
+import asyncio
+import cProfile
+import gc
+import logging
+import sys
+import threading
+import time
+import weakref
+from collections import Counter
+from os import makedirs, path
+
+import discordant.utils as utils
+
+
+def _handle_task(handle):
+    callback = getattr(handle, "_callback", None)
+    task = getattr(callback, "__self__", None)
+    if task is None and callback is not None:
+        # python 3.6's wakeup wrapper doesn't expose the task it wakes
+        task = next((x for x in gc.get_referents(callback)
+                     if isinstance(x, asyncio.Task)), None)
+    return task if isinstance(task, asyncio.Task) else None
+
+
+class _SlowCallbackFilter(logging.Filter):
+    # asyncio reports slow callbacks as "Executing <handle> took x seconds"
+    # while the handle is still the loop's current one, so the task that
+    # was stepped can be looked up in the tags that tag() recorded.
+    def __init__(self, loop, tags):
+        super().__init__()
+        self.loop = loop
+        self.tags = tags
+
+    def filter(self, record):
+        if record.msg.startswith("Executing"):
+            task = _handle_task(getattr(self.loop, "_current_handle", None))
+            if task is not None and task in self.tags:
+                record.msg = "[%s] " + record.msg
+                record.args = (self.tags[task],) + tuple(record.args)
+        return True
+
+
+class Profiler:
+    """Slow callback reporting and on-demand profiles of the running bot.
+
+    Everything here is off by default; tag() returns immediately until slow
+    callback reporting is turned on."""
+
+    max_threshold = 60
+    max_seconds = 300
+
+    def __init__(self, loop, output_dir="profiles"):
+        self.loop = loop
+        self.output_dir = output_dir
+        self.slow_callback_threshold = None
+        self.running = None  # (kind, file) of the profile in progress
+        self._tags = weakref.WeakKeyDictionary()  # task -> description
+        self._filter = _SlowCallbackFilter(loop, self._tags)
+
+    def tag(self, description, task=None):
+        if self.slow_callback_threshold is None:
+            return
+        task = task or utils.current_task()
+        if task is not None:
+            self._tags[task] = description[:100]
+
+    def watch_slow_callbacks(self, threshold):
+        if threshold is not None and \
+                not 0 < threshold <= self.max_threshold:
+            raise ValueError("The threshold must be between 0 and {}s."
+                             .format(self.max_threshold))
+        logger = logging.getLogger("asyncio")
+        if threshold is None:
+            self.loop.set_debug(False)
+            logger.removeFilter(self._filter)
+        else:
+            self.loop.slow_callback_duration = threshold
+            self.loop.set_debug(True)
+            logger.addFilter(self._filter)
+        self.slow_callback_threshold = threshold
+
+    def profile(self, kind, seconds, done=None):
+        """Profile the bot for the given number of seconds in the background.
+
+        kind is "cpu" for a cProfile dump (pstats format) or "sample" for a
+        folded-stack sampling profile that flamegraph tools can read. done,
+        if given, is called with the output file once it's written."""
+        if not 0 < seconds <= self.max_seconds:
+            raise ValueError("Profiles must be between 0 and {}s long.".format(
+                self.max_seconds))
+        if self.running:
+            raise RuntimeError("A {} profile is already running.".format(
+                self.running[0]))
+        makedirs(self.output_dir, exist_ok=True)
+        file = path.join(self.output_dir, "{}-{}.{}".format(
+            kind, time.strftime("%Y%m%d-%H%M%S"),
+            "prof" if kind == "cpu" else "folded"))
+        if kind == "cpu":
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+            def finish():
+                profiler.disable()
+                profiler.dump_stats(file)
+                self._finish(file, done)
+
+            self.loop.call_later(seconds, finish)
+        elif kind == "sample":
+            threading.Thread(
+                target=self._sample, daemon=True,
+                args=(threading.get_ident(), seconds, file, done)).start()
+        else:
+            raise ValueError("Unknown profile type: " + kind)
+        self.running = (kind, file)
+        return file
+
+    def _finish(self, file, done):
+        self.running = None
+        if done:
+            done(file)
+
+    def _sample(self, thread_id, seconds, file, done, interval=0.005):
+        stacks = Counter()
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{} ({}:{})".format(
+                    code.co_name, path.basename(code.co_filename),
+                    code.co_firstlineno))
+                frame = frame.f_back
+            stacks[";".join(reversed(stack))] += 1
+            time.sleep(interval)
+        with open(file, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write("{} {}\n".format(stack, count))
+        self.loop.call_soon_threadsafe(self._finish, file, done)
@@ -0,0 +1,72 @@
+import asyncio
+import heapq
+import itertools
+import math
+import sys
+import time
+import traceback
+
+
+class Scheduler:
+    """Runs deferred actions from a single task instead of a sleeper each.
+
+    Due times are rounded up to the next tick, and everything that comes due
+    in the same tick under the same key is handed to its action in one call,
+    so e.g. deletions in one channel can become a single bulk delete. Pending
+    actions live on the scheduler rather than the connection, and start()
+    only replaces the task if it has died, so they survive reconnects."""
+
+    def __init__(self, loop, tick=1.0):
+        self.loop = loop
+        self.tick = tick
+        self._heap = []  # (due, seq, key, action, items)
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, delay, key, action, items):
+        """Call the coroutine function action(items) after delay seconds.
+
+        Items scheduled under the same key that come due together are
+        merged, and action is called once with all of them."""
+        due = math.ceil((time.monotonic() + delay) / self.tick) * self.tick
+        heapq.heappush(
+            self._heap, (due, next(self._seq), key, action, list(items)))
+        self._wakeup.set()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = self.loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                await self._wakeup.wait()
+            else:
+                delay = self._heap[0][0] - time.monotonic()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+            self._wakeup.clear()
+            await self._run_due()
+
+    async def _run_due(self):
+        now = time.monotonic()
+        batches = {}
+        while self._heap and self._heap[0][0] <= now:
+            _, _, key, action, items = heapq.heappop(self._heap)
+            if key in batches:
+                batches[key][1].extend(items)
+            else:
+                batches[key] = (action, items)
+        for action, items in batches.values():
+            try:
+                await action(items)
+            except Exception:
+                print("Error in scheduled action:\n" + traceback.format_exc(),
+                      file=sys.stderr)
@@ -0,0 +1,272 @@
+import asyncio
+import math
+import sys
+import time
+import urllib.parse
+from collections import OrderedDict, deque
+
+import aiohttp
+
+
+class NotFound(Exception):
+    pass
+
+
+class UpstreamError(Exception):
+    def __init__(self, url, status):
+        super().__init__("{} returned HTTP {}".format(url, status))
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, host, deadline):
+        super().__init__("{} did not respond within {}s".format(
+            host, deadline))
+
+
+class CircuitOpen(Exception):
+    def __init__(self, host):
+        super().__init__("{} is unavailable, try again later".format(host))
+
+
+class LookupCache:
+    """Short-lived cache of upstream responses.
+
+    Concurrent lookups for the same key share a single request instead of
+    each going upstream. The request is cancelled once every lookup waiting
+    on it has been. Values are whole pages, so the cache is bounded by their
+    total size in bytes rather than by how many there are."""
+
+    def __init__(self, ttl=300, max_bytes=8 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()  # key -> (expiry, value, size)
+        self._pending = {}  # key -> future of the request in flight
+        self._waiters = {}  # key -> number of lookups waiting on it
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def get(self, key, fetch):
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[1]
+        if entry:
+            self._evict(key)
+        future = self._pending.get(key)
+        if future:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            future = asyncio.ensure_future(fetch())
+            self._pending[key] = future
+            future.add_done_callback(lambda f: self._done(key, f))
+        # shielded so one impatient caller can't cancel everyone's request
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(future)
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                if not future.done():
+                    future.cancel()
+
+    def _done(self, key, future):
+        self._pending.pop(key, None)
+        if future.cancelled() or future.exception() or self.ttl <= 0:
+            return
+        size = sys.getsizeof(future.result())
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._evict(key)
+        self._entries[key] = (
+            time.monotonic() + self.ttl, future.result(), size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            self._evict(next(iter(self._entries)))
+
+    def _evict(self, key):
+        self.bytes -= self._entries.pop(key)[2]
+
+
+class Site:
+    """Deadline, latency history and circuit breaker for one upstream host.
+
+    The breaker opens after failure_threshold consecutive failures and
+    rejects requests for reset_timeout seconds, after which a single probe
+    is let through (half-open). The probe's outcome closes or reopens it;
+    requests that were already in flight when it opened don't count."""
+
+    def __init__(self, host, deadline=10, failure_threshold=5,
+                 reset_timeout=30, hedge=False, hedge_min_samples=20):
+        self.host = host
+        self.deadline = deadline
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.hedge = hedge
+        self.hedge_min_samples = hedge_min_samples
+        self.state = "closed"
+        self.failures = 0
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.hedged = 0
+        self.latencies = deque(maxlen=200)
+        self._opened_at = 0
+        self._probing = False
+
+    def percentile(self, p):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1,
+                           int(math.ceil(p * len(ordered))) - 1)]
+
+    def hedge_delay(self):
+        if not self.hedge or len(self.latencies) < self.hedge_min_samples:
+            return None
+        return self.percentile(0.95)
+
+    def allow(self):
+        if self.state == "open":
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self.state = "half-open"
+        if self.state == "half-open":
+            if self._probing:
+                return False
+            self._probing = True
+        return True
+
+    def success(self, latency, probe=False):
+        self.latencies.append(latency)
+        if probe:
+            self.state = "closed"
+            self._probing = False
+        if self.state == "closed":
+            self.failures = 0
+
+    def failure(self, probe=False):
+        self.errors += 1
+        if probe:
+            self._probing = False
+        elif self.state != "closed":
+            return
+        self.failures += 1
+        if probe or self.failures >= self.failure_threshold:
+            self.state = "open"
+            self._opened_at = time.monotonic()
+
+    def abandon(self, probe):
+        # a cancelled probe tells us nothing, so let the next one through
+        if probe:
+            self._probing = False
+
+    def status(self):
+        p50, p95 = self.percentile(0.5), self.percentile(0.95)
+        latency = "p50 {:.0f}ms, p95 {:.0f}ms".format(
+            p50 * 1000, p95 * 1000) if p50 is not None else "no samples"
+        return "{}: {}, {}. {} requests, {} errors ({} timeouts), " \
+               "{} rejected, {} hedged.".format(
+                   self.host, self.state, latency, self.requests,
+                   self.errors, self.timeouts, self.rejected, self.hedged)
+
+
+class Upstream:
+    """Fetches from upstream sites through their per-site Site guards.
+
+    Settings in the config apply to every site, and can be overridden per
+    host under "sites". "rewrite" maps url prefixes to replacements, which
+    lets the load test point every site at a local stand-in."""
+
+    def __init__(self, config=None):
+        config = dict(config or {})
+        self._overrides = config.pop("sites", {})
+        self._rewrites = config.pop("rewrite", {})
+        self._defaults = config
+        self.sites = {}
+
+    def site(self, url):
+        host = urllib.parse.urlparse(url).hostname or ""
+        if host not in self.sites:
+            settings = dict(self._defaults)
+            settings.update(self._overrides.get(host, {}))
+            self.sites[host] = Site(host, **settings)
+        return self.sites[host]
+
+    async def fetch(self, url, read="text"):
+        site = self.site(url)
+        if not site.allow():
+            site.rejected += 1
+            raise CircuitOpen(site.host)
+        probe = site.state == "half-open"
+        site.requests += 1
+        for prefix, replacement in self._rewrites.items():
+            if url.startswith(prefix):
+                url = replacement + url[len(prefix):]
+                break
+        start = time.monotonic()
+        try:
+            result = await self._hedged_fetch(site, url, read)
+        except NotFound:
+            # the site answered just fine, there's just nothing there
+            site.success(time.monotonic() - start, probe)
+            raise
+        except asyncio.CancelledError:
+            site.abandon(probe)
+            raise
+        except Exception:
+            site.failure(probe)
+            raise
+        site.success(time.monotonic() - start, probe)
+        return result
+
+    async def _hedged_fetch(self, site, url, read):
+        # every lookup is a plain GET, so a second copy of a slow request
+        # is always safe to send.
+        deadline = time.monotonic() + site.deadline
+        tasks = [asyncio.ensure_future(fetch(url, read))]
+        hedge_delay = site.hedge_delay()
+        try:
+            if hedge_delay is not None:
+                done, _ = await asyncio.wait(
+                    tasks, timeout=min(hedge_delay, site.deadline))
+                if not done:
+                    site.hedged += 1
+                    tasks.append(asyncio.ensure_future(fetch(url, read)))
+            pending = tasks
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=max(0, deadline - time.monotonic()),
+                    return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    site.timeouts += 1
+                    raise DeadlineExceeded(site.host, site.deadline)
+                for task in done:
+                    if not task.exception() or \
+                            isinstance(task.exception(), NotFound):
+                        return task.result()
+            # every copy failed; report the original request's error
+            return tasks[0].result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+async def fetch(url, read="text"):
+    with aiohttp.ClientSession() as session:
+        async with session.get(url) as response:
+            if response.status == 404:
+                raise NotFound(url)
+            if not 200 <= response.status < 300:
+                # e.g. a 403/429 block page, which mustn't get cached
+                raise UpstreamError(url, response.status)
+            return await getattr(response, read)()
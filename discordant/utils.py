@@ -1,10 +1,15 @@
 import asyncio
 import re
 import shlex
+import time
+import unicodedata
 from datetime import datetime
+from functools import lru_cache
 
 import discord
 
+from discordant.kana import romaji_to_kana
+
 
 def split_every(s, n):
     return [s[i:i + n] for i in range(0, len(s), n)]
@@ -28,6 +33,102 @@ async def send_long_message(self, channel, message, truncate=False,
         await self.send_message(channel, msg)
 
 
+def current_task():
+    if hasattr(asyncio, "current_task"):
+        return asyncio.current_task()
+    return asyncio.Task.current_task()
+
+
+class ProgressiveReply:
+    """A reply that shows up before the lookup behind it has finished.
+
+    If the output isn't ready after placeholder_delay, a placeholder (or the
+    output so far) is sent, and then edited in place as update() is called,
+    at most once every edit_interval seconds. finish() puts the final output
+    into that message, chunked by long_message as usual. Lookups that finish
+    before the delay are sent like any other reply. If the lookup raises,
+    fail() replaces the placeholder so it isn't left behind. replies, if
+    given, is the Replies of the command the placeholder belongs to."""
+
+    def __init__(self, bot, channel, truncate=False, max_lines=15,
+                 placeholder="*Searching...*", placeholder_delay=0.5,
+                 edit_interval=1.0, replies=None):
+        self.bot = bot
+        self.channel = channel
+        self.truncate = truncate
+        self.max_lines = max_lines
+        self.placeholder = placeholder
+        self.placeholder_delay = placeholder_delay
+        self.edit_interval = edit_interval
+        self.replies = replies
+        self.message = None
+        self._output = ""
+        self._finished = False
+        self._last_edit = 0
+        self._pending = None
+        self._command = None
+        self._lock = asyncio.Lock()
+
+    def start(self):
+        # if the command gets cancelled, so do its placeholder and edits
+        self._command = current_task()
+        self.bot.track_replies(
+            asyncio.ensure_future(self._send_placeholder()), self.replies)
+        return self
+
+    def _cancelled(self):
+        return self._finished or (
+            self._command is not None and self._command.done())
+
+    async def update(self, output):
+        self._output = output
+        if self.message is None or self._pending or self._cancelled():
+            return
+        self._pending = asyncio.ensure_future(self._edit_after(
+            self._last_edit + self.edit_interval - time.monotonic()))
+
+    async def finish(self, output):
+        self._finished = True
+        chunks = long_message(output, self.truncate, self.max_lines)
+        # wait for a placeholder or edit that's already on its way
+        async with self._lock:
+            if self.message is not None:
+                await self.bot.edit_message(
+                    self.message, chunks[0] if chunks else "No results found.")
+                chunks = chunks[1:]
+            for chunk in chunks:
+                await self.bot.send_message(self.channel, chunk)
+
+    async def fail(self, output="Lookup failed."):
+        self._finished = True
+        async with self._lock:
+            if self.message is not None:
+                await self.bot.edit_message(self.message, output)
+
+    def _preview(self):
+        if not self._output:
+            return self.placeholder
+        return "\n".join(self._output.rstrip().split("\n")[
+            :self.max_lines])[:1900] + "\n" + self.placeholder
+
+    async def _send_placeholder(self):
+        await asyncio.sleep(self.placeholder_delay)
+        async with self._lock:
+            if not self._cancelled():
+                self.message = await self.bot.send_message(
+                    self.channel, self._preview())
+                self._last_edit = time.monotonic()
+
+    async def _edit_after(self, delay):
+        await asyncio.sleep(max(0, delay))
+        async with self._lock:
+            self._pending = None
+            if not self._cancelled():
+                self.message = await self.bot.edit_message(
+                    self.message, self._preview())
+                self._last_edit = time.monotonic()
+
+
 def get_kwargs(args_str, keys=None):
     return dict(
         x.split("=") for x in try_shlex(args_str)
@@ -153,6 +254,38 @@ def remove_spaces(s, all=False):
     return re.sub(r"\s?", "", s) if all else re.sub(r"\s+", " ", s).strip()
 
 
+def normalize_query(query, kana=False):
+    # folds full-width/half-width forms, whitespace and case so that
+    # equivalent queries share the same upstream url (and cache entry).
+    query = unicodedata.normalize("NFKC", query).casefold()
+    split = query.split()
+    if kana:
+        split = [romaji_to_kana(x) or x for x in split]
+    return " ".join(split)
+
+
+@lru_cache(maxsize=256)
+def highlight_pattern(terms, literal=True, flags=re.I):
+    # terms must be a tuple so that the compiled pattern can be cached.
+    # longest first, so that "take off" wins over "take" in the alternation.
+    terms = sorted({x for x in terms if x}, key=len, reverse=True)
+    if not terms:
+        return None
+    if not literal:
+        try:
+            return re.compile("|".join(terms), flags)
+        except re.error:  # upstream sent us something python can't read
+            pass
+    return re.compile("|".join(re.escape(x) for x in terms), flags)
+
+
+def highlight(text, pattern, fmt="**{}**"):
+    if pattern is None:
+        return text
+    return pattern.sub(
+        lambda m: fmt.format(m.group(0)) if m.group(0) else "", text)
+
+
 def try_shlex(s):
     try:
         split = shlex.split(s)
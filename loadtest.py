@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""Offline load test for the bot.
+
+Runs Discordant against a fake Discord transport, with every upstream site
+served from loadtest_fixtures/ by a local aiohttp stand-in, and reports
+throughput and command latency at increasing concurrency.
+
+The checked-in fixtures are synthetic, hand-written to match the parsers'
+xpaths (keep them in step), and far smaller than the real pages; --record
+swaps in real ones.
+
+usage: loadtest.py [--concurrency 1 4 16 64] [--messages 200]
+                   [--latency 0.05] [--error-rate 0.0] [--cache-ttl 0]
+       loadtest.py --record    (refresh the fixtures from the real sites)
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import re
+import statistics
+import tempfile
+import time
+import urllib.request
+from os import path
+from types import SimpleNamespace
+
+from aiohttp import web
+
+from discordant import Discordant
+
+ROOT_DIR = path.dirname(path.abspath(__file__))
+FIXTURE_DIR = path.join(ROOT_DIR, "loadtest_fixtures")
+
+SITES = ["jisho.org", "classic.jisho.org", "eow.alc.co.jp", "yourei.jp",
+         "nyanglish.com"]
+
+# (request path regex, fixture file, content type, url to record it from)
+# the files are synthetic until recorded, see the module docstring
+FIXTURES = [
+    (r"^/jisho\.org/api/v1/search/words", "jisho_words.json",
+     "application/json",
+     "http://jisho.org/api/v1/search/words?keyword=%E9%A3%9F%E3%81%B9%E3%82%8B"),
+    (r"^/jisho\.org/search/.*(%23|#)sentences", "jisho_sentences.html",
+     "text/html", "http://jisho.org/search/%E7%8C%AB%20%23sentences"),
+    (r"^/jisho\.org/search/.*(%23|#)names", "jisho_names.html",
+     "text/html", "http://jisho.org/search/%E7%94%B0%E4%B8%AD%20%23names"),
+    (r"^/jisho\.org/(search|word)/", "jisho_kanji.html", "text/html",
+     "http://jisho.org/search/%E6%97%A5%20%23kanji"),
+    (r"^/classic\.jisho\.org/static/images/stroke_diagrams/",
+     "stroke_diagram.png", "image/png",
+     "http://classic.jisho.org/static/images/stroke_diagrams/26085_frames.png"),
+    (r"^/eow\.alc\.co\.jp/search", "alc.html", "text/html",
+     "http://eow.alc.co.jp/search?q=take+off"),
+    (r"^/yourei\.jp/", "yourei.html", "text/html",
+     "http://yourei.jp/%E9%A3%9F%E3%81%B9%E3%82%8B"),
+    (r"^/nyanglish\.com/", "nyanglish.html", "text/html",
+     "http://nyanglish.com/apple"),
+]
+
+WORKLOAD = [
+    "!jisho 食べる",
+    "!jisho 2 ｔａｂｅｒｕ",
+    "!jisho 日 #kanji",
+    "!jisho 2 猫 #sentences",
+    "!jisho 2 田中 #names",
+    "!alc 2 take off",
+    "!yourei 3 食べる",
+    "!nyanglish 2 apple context=true",
+    "!so 日本",
+    "have a look http://jisho.org/search/%E9%A3%9F%E3%81%B9%E3%82%8B",
+    "http://eow.alc.co.jp/search?q=take+off",
+]
+
+
+class StandIn:
+    """Local stand-in for the upstream sites, with injected latency/errors."""
+
+    def __init__(self, latency, error_rate):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self._fixtures = []
+        for pattern, file, content_type, _ in FIXTURES:
+            with open(path.join(FIXTURE_DIR, file), "rb") as f:
+                self._fixtures.append(
+                    (re.compile(pattern), f.read(), content_type))
+
+    async def handle(self, request):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(random.expovariate(1 / self.latency))
+        if random.random() < self.error_rate:
+            return web.Response(status=503, text="injected error")
+        for pattern, body, content_type in self._fixtures:
+            if pattern.search(request.raw_path):
+                return web.Response(body=body, content_type=content_type)
+        return web.Response(status=404)
+
+    async def start(self, loop):
+        app = web.Application()
+        app.router.add_route("GET", "/{tail:.*}", self.handle)
+        self._server = await loop.create_server(
+            app.make_handler(), "127.0.0.1", 0)
+        return self._server.sockets[0].getsockname()[1]
+
+
+class LoadTestBot(Discordant):
+    """Discordant with the Discord transport replaced by counters."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, config_file):
+        super().__init__(config_file)
+        self._user = _fake_user("jp-bot")
+        self.sent = 0
+        self.files = 0
+        self.bytes_uploaded = 0
+
+    @property
+    def user(self):
+        return self._user
+
+    async def send_message(self, destination, content=None, **kwargs):
+        self.sent += 1
+        return _fake_message(content, destination, self._user)
+
+    async def send_file(self, destination, fp, *, filename=None,
+                        content=None, **kwargs):
+        self.files += 1
+        self.bytes_uploaded += len(fp.read())
+        return _fake_message(content, destination, self._user)
+
+    async def edit_message(self, message, new_content=None, **kwargs):
+        message.content = new_content
+        return message
+
+    async def delete_message(self, message):
+        pass
+
+    async def delete_messages(self, messages):
+        pass
+
+    async def change_presence(self, **kwargs):
+        pass
+
+
+def _fake_user(name):
+    return SimpleNamespace(id=str(next(LoadTestBot._ids)), name=name,
+                           nick=None, bot=False, mention="<@user>")
+
+
+def _fake_message(content, channel, author):
+    return SimpleNamespace(
+        id=str(next(LoadTestBot._ids)), content=content or "",
+        channel=channel, author=author, server=channel.server,
+        mentions=[], channel_mentions=[])
+
+
+def write_config(port, cache_ttl):
+    with open(path.join(ROOT_DIR, "config.json")) as f:
+        config = json.load(f)
+    config["lookup"]["cache_ttl"] = cache_ttl
+    config["analytics"]["database"] = ":memory:"
+    config.setdefault("upstream", {})["rewrite"] = {
+        "http://{}/".format(site): "http://127.0.0.1:{}/{}/".format(
+            port, site) for site in SITES}
+    file = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+    with file:
+        json.dump(config, file)
+    return file.name
+
+
+async def run_level(bot, concurrency, messages):
+    server = SimpleNamespace(id="1", name="loadtest")
+    channels = [SimpleNamespace(id=str(i), name="channel" + str(i),
+                                server=server, is_private=False)
+                for i in range(8)]
+    users = [_fake_user("user" + str(i)) for i in range(32)]
+    queue = asyncio.Queue()
+    for i in range(messages):
+        queue.put_nowait(_fake_message(
+            WORKLOAD[i % len(WORKLOAD)], random.choice(channels),
+            random.choice(users)))
+    latencies = []
+
+    async def worker():
+        while not queue.empty():
+            message = queue.get_nowait()
+            start = time.perf_counter()
+            await bot.on_message(message)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return (messages / elapsed, statistics.median(latencies) * 1000,
+            latencies[min(len(latencies) - 1,
+                          int(len(latencies) * 0.99))] * 1000)
+
+
+def record():
+    for _, file, _, url in FIXTURES:
+        print("recording", url)
+        with urllib.request.urlopen(url) as response:
+            data = response.read()
+        with open(path.join(FIXTURE_DIR, file), "wb") as f:
+            f.write(data)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, nargs="+",
+                        default=[1, 4, 16, 64])
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="mean upstream latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--cache-ttl", type=float, default=0,
+                        help="lookup cache ttl, 0 sends every lookup upstream")
+    parser.add_argument("--record", action="store_true")
+    args = parser.parse_args()
+    if args.record:
+        record()
+        return
+
+    loop = asyncio.get_event_loop()
+    stand_in = StandIn(args.latency, args.error_rate)
+    port = loop.run_until_complete(stand_in.start(loop))
+    bot = LoadTestBot(write_config(port, args.cache_ttl))
+
+    print("{:>11} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+        "concurrency", "msg/s", "p50 ms", "p99 ms", "replies", "upstream"))
+    for concurrency in args.concurrency:
+        sent, requests = bot.sent + bot.files, stand_in.requests
+        throughput, p50, p99 = loop.run_until_complete(
+            run_level(bot, concurrency, args.messages))
+        print("{:>11} {:>10.1f} {:>10.1f} {:>10.1f} {:>10} {:>10}".format(
+            concurrency, throughput, p50, p99, bot.sent + bot.files - sent,
+            stand_in.requests - requests))
+    print("uploaded {} files, {} bytes".format(bot.files, bot.bytes_uploaded))
+    for site in bot.upstream.sites.values():
+        print(site.status())
+
+
+if __name__ == '__main__':
+    main()